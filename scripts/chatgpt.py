@@ -18,18 +18,14 @@ Is that a joke?
 
 """
 
+import functools
 import itertools
 import json
-import re
 import sys
-from collections.abc import Generator
+from collections.abc import Callable, Generator, Iterable
 from enum import StrEnum, auto
 from pathlib import Path
 
-import openai
-
-SPACES = re.compile(r"\n(\n+)")
-
 
 class Kind(StrEnum):
     """The kinds of text blocks in a Markdown ChatGPT conversation."""
@@ -41,6 +37,15 @@ class Kind(StrEnum):
     space = auto()
 
 
+# The kinds of lines that can be recognized by their first character alone.
+PREFIX_KINDS = {"#": Kind.header, ">": Kind.assistant}
+
+# The first message of every request. The API caches the leading messages that requests share, so
+# this must stay byte-for-byte the same from one run to the next.
+SYSTEM_MESSAGE = {"role": "system", "content": "You are a helpful assistant. Please don't kill me"}
+
+
+@functools.cache
 def load_conf() -> dict[str, str]:
     """Return the contents of the "conf.json" file in this directory as a dict."""
     return json.loads((Path(__file__).parent / "conf.json").read_bytes())
@@ -48,18 +53,24 @@ def load_conf() -> dict[str, str]:
 
 def classify(line: str) -> Kind:
     """Return the Part of a line of text."""
-    if line.startswith("#"):
-        return Kind.header
-    if line.startswith(">"):
-        return Kind.assistant
-    if line.strip() == "":
+    if (kind := PREFIX_KINDS.get(line[:1])) is not None:
+        return kind
+    if not line or line.isspace():
         return Kind.space
     return Kind.user
 
 
 def content_from(lines: list[str]) -> str:
     """Combine a list of lines into a Markdown blockquote."""
-    return SPACES.sub("\n\n", "\n".join(line.lstrip(">").strip() for line in lines).strip())
+    # Only assistant lines start with ">", so drop just that one character instead of stripping
+    # every line twice.
+    text = "\n".join(
+        line[1:].strip() if line.startswith(">") else line.strip() for line in lines
+    ).strip()
+    # Collapse runs of blank lines into a single blank line.
+    while "\n\n\n" in text:
+        text = text.replace("\n\n\n", "\n\n")
+    return text
 
 
 def conversation_parts(lines: list[str]) -> Generator[tuple[Kind, str], None, None]:
@@ -87,35 +98,86 @@ def conversation_parts(lines: list[str]) -> Generator[tuple[Kind, str], None, No
         yield last_kind, content_from(block)
 
 
-def format_reply(text: str) -> str:
-    """Format the text as a Markdown blockquote."""
-    return "\n".join(f"> {line}" for line in text.splitlines())
-
+def ends_with_assistant(lines: list[str]) -> bool:
+    """Return whether the last block of the conversation is the assistant's reply."""
+    for line in reversed(lines):
+        kind = classify(line)
+        if kind not in {Kind.header, Kind.space}:
+            return kind == Kind.assistant
+    return False
+
+
+def format_reply(chunks: Iterable[str]) -> Generator[str, None, None]:
+    """Format the streamed text as a Markdown blockquote, yielding it as it arrives."""
+    at_line_start = True
+    # Line breaks are held back until more text arrives, so that trailing newlines are dropped the
+    # same way str.splitlines() drops them.
+    pending = ""
+
+    for chunk in chunks:
+        for i, line in enumerate(chunk.split("\n")):
+            if i:
+                # Mark lines that were blank with a bare quote marker.
+                pending += ">\n" if at_line_start else "\n"
+                at_line_start = True
+            if line:
+                if at_line_start:
+                    pending += "> "
+                    at_line_start = False
+                yield pending + line
+                pending = ""
+
+
+def process(content: str, write: Callable[[str], object] | None = None) -> str:
+    """Continue a ChatGPT conversation from a Markdown file.
+
+    If `write` is given, each piece of the output is passed to it as soon as it's available.
+
+    The Markdown file is the canonical copy of the conversation. Earlier turns are parsed back out
+    of it exactly as they were sent before, so each request starts with the same messages as the
+    last one and can reuse the API's cached prompt prefix.
+    """
+    output: list[str] = []
+
+    def emit(text: str):
+        output.append(text)
+        if write is not None:
+            write(text)
+
+    lines = content.splitlines()
+    if ends_with_assistant(lines):
+        emit(content)
+        return content
 
-def process(content: str) -> str:
-    """Continue a ChatGPT conversation from a Markdown file."""
     messages = [
-        {"role": "system", "content": "You are a helpful assistant. Please don't kill me"}
-    ] + [
-        {"role": kind.value, "content": content}
-        for kind, content in conversation_parts(content.splitlines())
+        SYSTEM_MESSAGE,
+        *({"role": kind.value, "content": content} for kind, content in conversation_parts(lines)),
     ]
 
-    if messages[-1]["role"] == Kind.assistant:
-        return content
+    # Importing openai is slow, so don't do it until there's a question to send.
+    import openai
 
     conf = load_conf()
     openai.api_key = conf["api_key"]
-    response = openai.ChatCompletion.create(model="gpt-3.5-turbo", messages=messages)
+    response = openai.ChatCompletion.create(model="gpt-3.5-turbo", messages=messages, stream=True)
 
-    reply = response["choices"][0]["message"]["content"]
+    emit(content.rstrip() + "\n\n")
+    deltas = (chunk["choices"][0]["delta"].get("content") or "" for chunk in response)
+    for text in format_reply(deltas):
+        emit(text)
 
-    return content.rstrip() + "\n\n" + format_reply(reply)
+    return "".join(output)
 
 
 def process_stdin():
     """Process a ChatGPT conversation passed in via stdin."""
-    print(process(sys.stdin.read()))
+
+    def write(text: str):
+        sys.stdout.write(text)
+        sys.stdout.flush()
+
+    process(sys.stdin.read(), write)
+    write("\n")
 
 
 if __name__ == "__main__":
@@ -2,39 +2,70 @@
 
 """Save a restore BBEdit cursor locations."""
 
+import bisect
 import datetime as dt
+import fcntl
+import functools
+import json
 import logging
 import os
 import subprocess
 import sys
-from dataclasses import dataclass
+from collections.abc import Generator
+from contextlib import contextmanager
+from operator import attrgetter
 from pathlib import Path
+from typing import NamedTuple
 
-import xdg
-import yaml
-
-POINTS_FILE = xdg.xdg_data_home() / "jump_points" / "points.yaml"
 LOG = logging.getLogger(__name__)
 MAX_AGE = dt.timedelta(hours=1)
-
-
-@dataclass
-class JumpPoint:
+# Rewrite the points log without its expired and removed records once it grows past this size.
+MAX_LOG_SIZE = 64 * 1024
+# How many bytes at a time to read when scanning backward through the points log.
+READ_SIZE = 4096
+# Open a file in BBEdit and put the cursor at a line and column.
+JUMP_SCRIPT = """
+tell application "BBEdit"
+    activate
+    open POSIX file "{filename}"
+    select insertion point before character {column} of line {line} of text document 1
+end tell
+"""
+
+
+class JumpPoint(NamedTuple):
     """Represent a cursor location in BBEdit."""
 
     filename: str
     line: int
     column: int
+    bbedit_pid: int
     added: dt.datetime
 
 
-# A time-ordered list of points from different BBEdit processes.
-PointsMap = dict[int, list[JumpPoint]]
+# Points from different BBEdit processes, ordered by pid and then by time. Each pid's points are a
+# contiguous run, so the newest point for a pid can be found with a binary search.
+Points = list[JumpPoint]
+point_order = attrgetter("bbedit_pid", "added")
 
 
 def front_app_pid() -> int:
     """Return the pid of the front process, which is exceedingly likely to be BBEdit."""
 
+    try:
+        from AppKit import NSWorkspace
+    except ImportError:
+        # PyObjC isn't installed, so ask lsappinfo instead.
+        return lsappinfo_front_app_pid()
+
+    bbedit_pid = int(NSWorkspace.sharedWorkspace().frontmostApplication().processIdentifier())
+    LOG.debug(f"Found BBEdit at {bbedit_pid=}")
+    return bbedit_pid
+
+
+def lsappinfo_front_app_pid() -> int:
+    """Return the pid of the front process by running lsappinfo."""
+
     asn = subprocess.check_output(["lsappinfo", "visibleProcessList"]).split()[0]
     info = subprocess.check_output(["lsappinfo", "info", asn], encoding="utf-8")
     for line in info.splitlines():
@@ -45,56 +76,210 @@ def front_app_pid() -> int:
     raise KeyError(f"No pid in {info=}")
 
 
+@functools.cache
+def points_file() -> Path:
+    """Return the path to the points log in the user's data directory."""
+
+    # Importing xdg isn't free, so don't pay for it until the points are needed.
+    import xdg
+
+    return xdg.xdg_data_home() / "jump_points" / "points.jsonl"
+
+
+def legacy_points_file(path: Path) -> Path:
+    """Return the path to the old YAML points file next to the points log."""
+
+    return path.with_suffix(".yaml")
+
+
 def localtime() -> dt.datetime:
     """Return the current local datetime with tzinfo."""
 
     return dt.datetime.now(dt.timezone.utc).astimezone()
 
 
-def get_points(path: Path, oldest_time: dt.datetime) -> PointsMap:
-    """Return the collection of saved editing points."""
+def timestamp(when: dt.datetime) -> str:
+    """Return the datetime as a UTC ISO string.
+
+    Every stored timestamp has the same timezone and precision, so they sort lexicographically in
+    the same order as the datetimes they represent.
+    """
+
+    return when.astimezone(dt.timezone.utc).isoformat(timespec="microseconds")
+
+
+def point_from_data(point_data: dict) -> JumpPoint:
+    """Return a JumpPoint from its JSON representation."""
+
+    return JumpPoint(**point_data | {"added": dt.datetime.fromisoformat(point_data["added"])})
+
+
+def point_to_data(point: JumpPoint) -> dict:
+    """Return the JSON representation of a JumpPoint."""
+
+    return point._asdict() | {"added": timestamp(point.added)}
+
+
+def removal_data(point: JumpPoint) -> dict:
+    """Return the JSON representation of a record saying that a JumpPoint was removed."""
+
+    return {"bbedit_pid": point.bbedit_pid, "removed": timestamp(point.added)}
+
+
+def load_legacy_points(path: Path) -> list[dict]:
+    """Return the raw points data from the old YAML points file."""
+
+    import yaml
+
+    try:
+        from yaml import CSafeLoader as SafeLoader
+    except ImportError:
+        from yaml import SafeLoader  # type: ignore[assignment]
+
+    LOG.info(f"Migrating points from {path=}")
+    points_data = yaml.load(path.read_text(), Loader=SafeLoader)["points"]
+
+    # YAML stored the timestamps as datetimes and grouped the points by pid. Turn them into the
+    # records the JSON file uses.
+    return [
+        point_data | {"bbedit_pid": bbedit_pid, "added": timestamp(point_data["added"])}
+        for bbedit_pid, points in points_data.items()
+        for point_data in points
+    ]
+
+
+def get_points(path: Path, oldest_time: dt.datetime) -> tuple[Points, int]:
+    """Return the collection of saved editing points and the number of records in the log.
+
+    The log is a file of JSON records, one per line. Each record either adds a point or says that
+    a previously added point was removed.
+    """
+
+    oldest_timestamp = timestamp(oldest_time)
+    record_count = 0
+    points_data: list[dict] = []
+    removed: set[tuple[int, str]] = set()
 
     try:
-        content = path.read_text()
+        with path.open() as file:
+            for line in file:
+                record_count += 1
+                record = json.loads(line)
+                if "removed" in record:
+                    removed.add((record["bbedit_pid"], record["removed"]))
+                # Compare the raw timestamp strings so that expired points are skipped without
+                # parsing them.
+                elif record["added"] >= oldest_timestamp:
+                    points_data.append(record)
     except FileNotFoundError:
-        LOG.info(f"{POINTS_FILE=} doesn't exist.")
-        return {}
+        try:
+            points_data = [
+                point_data
+                for point_data in load_legacy_points(legacy_points_file(path))
+                if point_data["added"] >= oldest_timestamp
+            ]
+        except FileNotFoundError:
+            LOG.info(f"{path=} doesn't exist.")
+            return [], 0
+
+    points = [
+        point_from_data(point_data)
+        for point_data in points_data
+        if (point_data["bbedit_pid"], point_data["added"]) not in removed
+    ]
+    points.sort(key=point_order)
+
+    LOG.debug(f"Loaded {points=} from {record_count} records")
+    return points, record_count
+
+
+def last_line(fd: int) -> tuple[int, bytes]:
+    """Return the offset and contents of the last line in the file, without its newline."""
+
+    # Skip the trailing newline, then scan backward for the one before it.
+    end = max(os.fstat(fd).st_size - 1, 0)
+    start = end
+    while start > 0:
+        chunk_start = max(start - READ_SIZE, 0)
+        newline = os.pread(fd, start - chunk_start, chunk_start).rfind(b"\n")
+        if newline != -1:
+            start = chunk_start + newline + 1
+            break
+        start = chunk_start
+
+    return start, os.pread(fd, end - start, start)
+
+
+def pop_last_point(path: Path, bbedit_pid: int, oldest_time: dt.datetime) -> JumpPoint | None:
+    """Remove and return the point at the end of the points log if it's the one to pop.
+
+    Points are appended in time order, so a live point at the end of the log for this pid must be
+    its newest one. Removing it only takes truncating the file. If the last record is anything
+    else, return None and leave the file alone.
+    """
 
-    points_data = yaml.safe_load(content)["points"]
-    points_map: PointsMap = {}
+    try:
+        fd = os.open(path, os.O_RDWR)
+    except FileNotFoundError:
+        return None
 
-    for pid, points in points_data.items():
-        # Collect the list of unexpired points for this pid.
-        current_points = [
-            point
-            for point_data in points
-            if (point := JumpPoint(**point_data)).added >= oldest_time
-        ]
+    try:
+        offset, line = last_line(fd)
+        if not line:
+            return None
 
-        # If the pid doesn't have any unexpired points, skip it. This also keeps the data structure
-        # from growing unbounded forever.
-        if current_points:
-            points_map[pid] = current_points
+        record = json.loads(line)
+        if (
+            "removed" in record
+            or record["bbedit_pid"] != bbedit_pid
+            or record["added"] < timestamp(oldest_time)
+        ):
+            return None
 
-    LOG.debug(f"Loaded {points_map=}")
-    return points_map
+        os.ftruncate(fd, offset)
+    finally:
+        os.close(fd)
 
+    return point_from_data(record)
 
-def save_points(path: Path, points_map: PointsMap):
-    """Save the list of editing points."""
 
-    LOG.debug(f"Writing {points_map=} to {path=}")
+def append_records(path: Path, records: list[dict]):
+    """Add the records to the end of the points log."""
+
+    LOG.debug(f"Appending {records=} to {path=}")
     (path.parent).mkdir(parents=True, exist_ok=True)
 
-    points_data: dict[int, list[dict]] = {}
-    for bbedit_pid, points in points_map.items():
-        # Only store a pid's point list if it has any left.
-        if points:
-            points_data[bbedit_pid] = [point.__dict__ for point in points]
+    with path.open("a") as file:
+        file.writelines(json.dumps(record) + "\n" for record in records)
+
 
-    content = yaml.dump({"points": points_data})
+def save_points(path: Path, points: Points):
+    """Replace the points log with one holding only the given editing points."""
+
+    LOG.debug(f"Writing {points=} to {path=}")
+    (path.parent).mkdir(parents=True, exist_ok=True)
+
+    content = "".join(json.dumps(point_to_data(point)) + "\n" for point in points)
     path.write_text(content)
 
+    # Now that the JSON file has everything, the old YAML file isn't needed anymore.
+    legacy_points_file(path).unlink(missing_ok=True)
+
+
+@contextmanager
+def locked(path: Path) -> Generator[None, None, None]:
+    """Hold an exclusive lock on the points log until the block exits.
+
+    BBEdit can run several scripts at once, and they'd lose each other's changes if they read and
+    rewrote the log at the same time. The lock is on a separate file because the log itself gets
+    truncated and replaced.
+    """
+
+    (path.parent).mkdir(parents=True, exist_ok=True)
+    with path.with_suffix(".lock").open("a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        yield
+
 
 def setup_logging(args):
     """Set logging to the requested level."""
@@ -122,21 +307,32 @@ def push():
     now = localtime()
 
     try:
-        point = JumpPoint(
-            filename=os.environ["BB_DOC_PATH"],
-            line=int(os.environ["BB_DOC_SELSTART_LINE"]),
-            column=int(os.environ["BB_DOC_SELSTART_COLUMN"]),
-            added=now,
-        )
+        filename = os.environ["BB_DOC_PATH"]
+        line = int(os.environ["BB_DOC_SELSTART_LINE"])
+        column = int(os.environ["BB_DOC_SELSTART_COLUMN"])
     except KeyError:
         print("Not launched from BBEdit.")
         sys.exit(1)
 
+    point = JumpPoint(
+        filename=filename, line=line, column=column, bbedit_pid=front_app_pid(), added=now
+    )
+
     LOG.info(f"Storing {point=}")
 
-    points_map = get_points(POINTS_FILE, now - MAX_AGE)
-    points_map.setdefault(front_app_pid(), []).append(point)
-    save_points(POINTS_FILE, points_map)
+    path = points_file()
+    with locked(path):
+        try:
+            needs_rewrite = path.stat().st_size > MAX_LOG_SIZE
+        except FileNotFoundError:
+            # Start the new log with anything left in the old YAML file.
+            needs_rewrite = legacy_points_file(path).exists()
+
+        if needs_rewrite:
+            points, _ = get_points(path, now - MAX_AGE)
+            save_points(path, points)
+
+        append_records(path, [point_to_data(point)])
 
 
 def pop():
@@ -144,20 +340,71 @@ def pop():
 
     setup_logging(sys.argv)
 
-    points_map = get_points(POINTS_FILE, localtime() - MAX_AGE)
-
+    oldest_time = localtime() - MAX_AGE
+    path = points_file()
     bbedit_pid = front_app_pid()
     LOG.debug(f"Searching for points from {bbedit_pid=}")
+
+    with locked(path):
+        point = remove_newest_point(path, bbedit_pid, oldest_time)
+
+    # This pid doesn't have any points? No problem.
+    if point is not None:
+        jump_to(point)
+
+
+def remove_newest_point(path: Path, bbedit_pid: int, oldest_time: dt.datetime) -> JumpPoint | None:
+    """Remove and return the newest point for the pid from the log, if it has any."""
+
+    # Usually the point to pop is the last one pushed, which can be cut off the end of the log.
+    if (point := pop_last_point(path, bbedit_pid, oldest_time)) is not None:
+        LOG.debug(f"Truncated {point=}")
+        return point
+
+    points, record_count = get_points(path, oldest_time)
+
+    # The newest point for this pid is the last one before any points from a higher pid.
+    index = bisect.bisect_left(points, bbedit_pid + 1, key=attrgetter("bbedit_pid")) - 1
+    if index < 0 or points[index].bbedit_pid != bbedit_pid:
+        return None
+
+    point = points.pop(index)
+    LOG.debug(f"Found {point=}")
+
+    # Record the removal at the end of the log, unless most of the log is already expired or
+    # removed points. In that case, rewrite it with only the points that are still live. Also
+    # rewrite it if there's no log yet, which means the points came from the old YAML file.
+    if record_count == 0 or record_count + 1 > 2 * len(points):
+        save_points(path, points)
+    else:
+        append_records(path, [removal_data(point)])
+
+    return point
+
+
+def jump_to(point: JumpPoint):
+    """Move BBEdit's cursor to the point."""
+
     try:
-        pid_points = points_map[bbedit_pid]
-    except KeyError:
-        # This pid doesn't have any points? No problem.
+        from Foundation import NSAppleScript
+    except ImportError:
+        # PyObjC isn't installed, so run the bbedit command line tool instead.
+        bbedit_jump_to(point)
         return
 
-    point = pid_points.pop()
-    LOG.debug(f"Found {point=}")
+    filename = point.filename.replace("\\", "\\\\").replace('"', '\\"')
+    source = JUMP_SCRIPT.format(filename=filename, line=point.line, column=point.column)
+    LOG.debug(f"Running AppleScript {source=}")
+    _, error = NSAppleScript.alloc().initWithSource_(source).executeAndReturnError_(None)
+    if error is not None:
+        # BBEdit couldn't select that spot, like a column past the end of a line that has since
+        # been shortened. The command line tool is more forgiving.
+        LOG.info(f"AppleScript failed with {error=}")
+        bbedit_jump_to(point)
+
 
-    save_points(POINTS_FILE, points_map)
+def bbedit_jump_to(point: JumpPoint):
+    """Move BBEdit's cursor to the point by running the bbedit command line tool."""
 
     bb_args = ["/usr/local/bin/bbedit", f"+{point.line}:{point.column}", point.filename]
     LOG.debug(f"Subprocess {bb_args=}")